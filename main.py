@@ -106,6 +106,8 @@ class DisclosePEEScraper(AddOn):
 
         self.dry_run = self.data.get("dry_run")
 
+        self.incremental = self.data.get("incremental", False)
+
         if not self.dry_run:
             try:
                 self.project = self.get_project_id()
@@ -144,6 +146,7 @@ class DisclosePEEScraper(AddOn):
             store_event_data=self.store_event_data,
             upload_file=self.upload_file,
             upload_event_data=self.upload_event_data,
+            incremental=self.incremental,
         )
 
         # Run
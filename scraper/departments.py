@@ -180,6 +180,45 @@ REGIONS = {
 }
 
 
+def _names_alternation(names):
+    """Builds a regex alternation from a list of names, longest first."""
+
+    return "|".join(re.escape(n) for n in sorted(set(names), key=len, reverse=True))
+
+
+# Parentheses with possible department numbers in project name
+PARENTHESES_RE = re.compile(r"\(([A-B0-9 \-,;//\+]+(?: et[A-B0-9 \-,;//]+)?)\)")
+
+DEPARTMENT_NUMBER_RE = re.compile(
+    r"\b([02][1-9]|2[AB]|[1345678][0-9]|9[012345]|97[1-8])\b"
+)
+
+# Department names (with or without hyphens) and region names, lowercased
+_DEPARTMENT_NAMES = {dept.lower(): DEPARTMENTS[dept] for dept in DEPARTMENTS}
+_DEPARTMENT_NAMES_NO_HYPHENS = {
+    dept.replace("-", " ").lower(): DEPARTMENTS[dept] for dept in DEPARTMENTS
+}
+_REGION_NAMES = {}
+for _reg in REGIONS:
+    _REGION_NAMES.setdefault(_reg.lower(), set()).update(REGIONS[_reg])
+    _REGION_NAMES.setdefault(_reg.replace("-", " ").lower(), set()).update(
+        REGIONS[_reg]
+    )
+
+DEPARTMENT_NAME_RE = re.compile(
+    rf"\(({_names_alternation(DEPARTMENTS)})\)", re.IGNORECASE
+)
+
+DEPARTMENT_NAME_NO_HYPHENS_RE = re.compile(
+    rf"\(({_names_alternation(d.replace('-', ' ') for d in DEPARTMENTS)})\)$",
+    re.IGNORECASE,
+)
+
+REGION_NAME_RE = re.compile(
+    rf"\brégion ({_names_alternation(_REGION_NAMES)})\b", re.IGNORECASE
+)
+
+
 def department_from_authority(authority):
     """Match department from authority field. Returns 1 dept code as string or an empty string."""
 
@@ -198,19 +237,14 @@ def departments_from_project_name(project_name):
     departments = []
 
     # Find parentheses with possible matches in project
-    matches_parentheses = re.findall(
-        r"\(([A-B0-9 \-,;//\+]+(?: et[A-B0-9 \-,;//]+)?)\)", project_name
-    )
-    #
+    matches_parentheses = PARENTHESES_RE.findall(project_name)
 
     # Extract departments from matches
     for m in matches_parentheses:
         # Replacing + by space, as it is not considered a word boundary
         m = m.replace("+", " ")
 
-        match_dept_nos = re.findall(
-            r"\b([02][1-9]|2[AB]|[1345678][0-9]|9[012345]|97[1-8])\b", m
-        )
+        match_dept_nos = DEPARTMENT_NUMBER_RE.findall(m)
 
         if match_dept_nos:
             for d in match_dept_nos:
@@ -218,28 +252,17 @@ def departments_from_project_name(project_name):
 
     # By department name in parentheses
     if not departments:
-        for dept in DEPARTMENTS:
-            # escaped_dept = dept = dept.replace("'", "'")
-            dept_no_hyphens = dept.replace("-", " ")
+        for match in DEPARTMENT_NAME_RE.finditer(project_name):
+            departments.append(_DEPARTMENT_NAMES[match.group(1).lower()])
 
-            if re.search(rf"\({dept}\)", project_name, re.IGNORECASE) or re.search(
-                rf"\({dept_no_hyphens}\)$", project_name, re.IGNORECASE
-            ):
-                departments.append(DEPARTMENTS[dept])
+        match = DEPARTMENT_NAME_NO_HYPHENS_RE.search(project_name)
+        if match:
+            departments.append(_DEPARTMENT_NAMES_NO_HYPHENS[match.group(1).lower()])
 
     # By Region name
     if not departments:
-        for reg in REGIONS:
-            # escaped_region = reg.replace("'", "'")
-            reg_no_hyphens = reg.replace("-", " ")
-
-            if re.search(
-                rf"\brégion {reg}\b", project_name, re.IGNORECASE
-            ) or re.search(
-                rf"\brégion {reg_no_hyphens}\b", project_name, re.IGNORECASE
-            ):
-                for d in REGIONS[reg]:
-                    departments.append(d)
+        for match in REGION_NAME_RE.finditer(project_name):
+            departments.extend(_REGION_NAMES[match.group(1).lower()])
 
     # Remove duplicates & order
     departments = sorted(list(set(departments)))
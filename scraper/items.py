@@ -1,44 +1,46 @@
 """Models for the scraped items."""
 
-from scrapy.item import Item, Field
+from dataclasses import dataclass
+from typing import Optional
 
 
-class DocumentItem(Item):
+@dataclass(slots=True)
+class DocumentItem:
     """A document that will be uploaded to DocumentCloud."""
 
-    title = Field()
-    project = Field()
-    project_id = Field()
+    title: Optional[str] = None
+    project: Optional[str] = None
+    project_id: Optional[str] = None
 
-    source = Field()
-    access = Field()
-    authority = Field()
+    source: Optional[str] = None
+    access: Optional[str] = None
+    authority: Optional[str] = None
 
-    category = Field()
-    category_local = Field()
+    category: Optional[str] = None
+    category_local: Optional[str] = None
 
-    source_scraper = Field()
-    source_file_url = Field()
-    source_filename = Field()
-    source_page_url = Field()
+    source_scraper: Optional[str] = None
+    source_file_url: Optional[str] = None
+    source_filename: Optional[str] = None
+    source_page_url: Optional[str] = None
 
-    publication_date = Field()
-    publication_time = Field()
-    publication_datetime = Field()
-    publication_datetime_dcformat = Field()
+    publication_date: Optional[str] = None
+    publication_time: Optional[str] = None
+    publication_datetime: Optional[str] = None
+    publication_datetime_dcformat: Optional[str] = None
 
-    publication_timestamp = Field()
-    # publication_lastmodified = Field()
+    publication_timestamp: Optional[str] = None
+    # publication_lastmodified: Optional[str] = None
 
-    full_info = Field()
+    full_info: Optional[dict] = None
 
-    headers = Field()
+    headers: Optional[dict] = None
 
-    error = Field()
+    error: Optional[str] = None
 
-    year = Field()
+    year: Optional[str] = None
 
-    departments = Field()
-    departments_sources = Field()
+    departments: Optional[list] = None
+    departments_sources: Optional[list] = None
 
-    local_file_path = Field()
+    local_file_path: Optional[str] = None
@@ -1,6 +1,7 @@
 # Item Pipelines
 
 import datetime
+import functools
 import re
 import os
 from urllib.parse import urlparse
@@ -9,10 +10,18 @@ import json
 import hashlib
 import shutil
 import sys
+import tempfile
+import time
 
-from itemadapter import ItemAdapter
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from scrapy.exceptions import DropItem
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet.defer import DeferredSemaphore
+from twisted.internet.threads import deferToThread
 
 from documentcloud.constants import SUPPORTED_EXTENSIONS
 
@@ -20,6 +29,31 @@ from .log import SilentDropItem
 from .departments import department_from_authority, departments_from_project_name
 
 
+def dumps_json(data):
+    """Serializes data to JSON bytes, with orjson if available."""
+
+    if orjson:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
+
+
+def loads_json(raw):
+    """Deserializes JSON bytes, with orjson if available."""
+
+    if orjson:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def event_data_file_id(url):
+    """Returns the file id (ctsFileId) of an event_data key, or None."""
+
+    try:
+        return int(url.rpartition("ctsFileId=")[2])
+    except ValueError:
+        return None
+
+
 class SpiderPipeline:
     """Base class for pipelines that need access to the spider instance.
 
@@ -34,6 +68,24 @@ class SpiderPipeline:
         return pipeline
 
 
+@functools.lru_cache(maxsize=4096)
+def parse_timestamp(timestamp):
+    """Parses a timestamp from the API. Attachments of a project share the same one."""
+
+    try:
+        dt = datetime.datetime.fromisoformat(timestamp)
+    except ValueError:
+        # fromisoformat is stricter on fractional seconds before Python 3.11
+        return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%f")
+
+    # fromisoformat also accepts "Z" / "+HH:MM" suffixes: dates are formatted as
+    # naive UTC afterwards, so convert them
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return dt
+
+
 class ParseDatePipeline:
     """Parse dates from scraped data."""
 
@@ -42,18 +94,14 @@ class ParseDatePipeline:
 
         # Publication date
 
-        publication_dt = datetime.datetime.strptime(
-            item["publication_timestamp"], "%Y-%m-%dT%H:%M:%S.%f"
-        )
+        publication_dt = parse_timestamp(item.publication_timestamp)
 
-        item["publication_date"] = publication_dt.strftime("%Y-%m-%d")
-        item["publication_time"] = publication_dt.strftime("%H:%M:%S UTC")
+        item.publication_date = publication_dt.strftime("%Y-%m-%d")
+        item.publication_time = publication_dt.strftime("%H:%M:%S UTC")
 
-        item["publication_datetime"] = (
-            item["publication_date"] + " " + item["publication_time"]
-        )
+        item.publication_datetime = item.publication_date + " " + item.publication_time
 
-        item["publication_datetime_dcformat"] = (
+        item.publication_datetime_dcformat = (
             publication_dt.isoformat(timespec="microseconds") + "Z"
         )
 
@@ -64,7 +112,7 @@ class UnsupportedFiletypePipeline:
 
     def process_item(self, item):
 
-        filename, file_extension = os.path.splitext(item["source_filename"])
+        filename, file_extension = os.path.splitext(item.source_filename)
         file_extension = file_extension.lower()
 
         if file_extension not in SUPPORTED_EXTENSIONS:
@@ -74,40 +122,40 @@ class UnsupportedFiletypePipeline:
             return item
 
 
+# Authority names harmonized by BeautifyPipeline
+AUTHORITY_REPLACEMENTS = (
+    ("Préfet de la région", "Préfecture de région"),
+    ("MRae de la région", "MRAe"),
+    ("Autorité Environnementale Ministre (CGDD)", "Ministère de l'Environnement"),
+)
+
+
 class BeautifyPipeline:
     def process_item(self, item):
         """Beautify & harmonize project & title names."""
 
         # Project
-        item["project"] = item["project"].strip()
-        item["project"] = item["project"].replace(" ", " ").replace("’", "'")
-        item["project"] = item["project"].rstrip(".,")
+        item.project = item.project.strip()
+        item.project = item.project.replace("\u00a0", " ").replace("’", "'")
+        item.project = item.project.rstrip(".,")
 
-        item["project"] = item["project"][0].capitalize() + item["project"][1:]
+        item.project = item.project[0].capitalize() + item.project[1:]
 
         # Title
-        item["title"] = item["title"].replace("_", " ")
-        item["title"] = item["title"].rstrip(".,")
-        item["title"] = item["title"].strip("-")
-        item["title"] = item["title"].strip()
+        item.title = item.title.replace("_", " ")
+        item.title = item.title.rstrip(".,")
+        item.title = item.title.strip("-")
+        item.title = item.title.strip()
 
-        item["title"] = item["title"][0].capitalize() + item["title"][1:]
+        item.title = item.title[0].capitalize() + item.title[1:]
 
         # Authority
-
-        item["authority"] = item["authority"].replace(
-            "Préfet de la région", "Préfecture de région"
-        )
-
-        item["authority"] = item["authority"].replace("MRae de la région", "MRAe")
-
-        item["authority"] = item["authority"].replace(
-            "Autorité Environnementale Ministre (CGDD)", "Ministère de l'Environnement"
-        )
+        for old, new in AUTHORITY_REPLACEMENTS:
+            item.authority = item.authority.replace(old, new)
 
         # Category
-        item["category_local"] = (
-            item["category_local"].replace(" ", " ").replace("’", "'")
+        item.category_local = item.category_local.replace("\u00a0", " ").replace(
+            "’", "'"
         )
 
         return item
@@ -120,18 +168,18 @@ class CategoryPipeline(SpiderPipeline):
 
         spider = self.spider
 
-        if "cas par cas" in item["category_local"].lower():
-            item["category"] = "Cas par cas"
+        if "cas par cas" in item.category_local.lower():
+            item.category = "Cas par cas"
 
-        elif item["category_local"].startswith("Demande d'avis"):
-            item["category"] = "Avis"
+        elif item.category_local.startswith("Demande d'avis"):
+            item.category = "Avis"
 
-        elif item["category_local"] in ["Avis", "Avis Projet"]:
-            item["category"] = "Avis"
+        elif item.category_local in ["Avis", "Avis Projet"]:
+            item.category = "Avis"
 
         else:
             subject = "Maintenance needed on portail-ee-scraper"
-            content = f"A new category has appeared: {item['category_local']}. Modify the code to import the documents in the correct category."
+            content = f"A new category has appeared: {item.category_local}. Modify the code to import the documents in the correct category."
             spider.send_mail(subject, content)
             raise DropItem("Unknown category_local")
 
@@ -159,20 +207,20 @@ class TagDepartmentsPipeline:
 
     def process_item(self, item):
 
-        authority_department = department_from_authority(item["authority"])
+        authority_department = department_from_authority(item.authority)
 
         if authority_department:
-            item["departments_sources"] = ["authority"]
-            item["departments"] = [authority_department]
+            item.departments_sources = ["authority"]
+            item.departments = [authority_department]
 
         else:
 
-            project_departments = departments_from_project_name(item["project"])
+            project_departments = departments_from_project_name(item.project)
 
             if project_departments:
 
-                item["departments_sources"] = ["regex"]
-                item["departments"] = project_departments
+                item.departments_sources = ["regex"]
+                item.departments = project_departments
 
         return item
 
@@ -181,14 +229,14 @@ class ProjectIDPipeline:
 
     def process_item(self, item):
 
-        project_name = item["project"]
-        source_page_url = item["source_page_url"]
+        project_name = item.project
+        source_page_url = item.source_page_url
         string_to_hash = source_page_url + " " + project_name
 
         hash_object = hashlib.sha256(string_to_hash.encode())
         hex_dig = hash_object.hexdigest()
 
-        item["project_id"] = hex_dig
+        item.project_id = hex_dig
 
         return item
 
@@ -196,8 +244,22 @@ class ProjectIDPipeline:
 class UploadPipeline(SpiderPipeline):
     """Upload document to DocumentCloud & store event data."""
 
+    # Store event data every N uploads or every N seconds, whichever comes first
+    EVENT_DATA_FLUSH_SIZE = 50
+    EVENT_DATA_FLUSH_INTERVAL = 30
+
     def open_spider(self):
         spider = self.spider
+
+        self._dirty_count = 0
+        self._last_flush = time.monotonic()
+
+        # Limit the uploads running at once, so they do not take every thread of
+        # the reactor pool away from DNS resolution and file writes
+        self.upload_semaphore = DeferredSemaphore(
+            spider.settings.getint("UPLOAD_CONCURRENCY", 1)
+        )
+
         documentcloud_logger = logging.getLogger("documentcloud")
         documentcloud_logger.setLevel(logging.WARNING)
         squarelet_logger = logging.getLogger("squarelet")
@@ -216,9 +278,9 @@ class UploadPipeline(SpiderPipeline):
             # Load from json if present
             try:
 
-                with open("event_data.json", "r") as file:
+                with open("event_data.json", "rb") as file:
                     spider.logger.info("Loading event data from local JSON file...")
-                    data = json.load(file)
+                    data = loads_json(file.read())
                     spider.event_data = data
             except:
                 spider.event_data = {}
@@ -239,66 +301,93 @@ class UploadPipeline(SpiderPipeline):
                 "target_year": "2025",
             }
 
-    def process_item(self, item):
+        # File ids of the event data, faster to look up than the URL keys
+        spider.event_data_ids = {
+            event_data_file_id(url) for url in spider.event_data
+        } - {None}
+
+    async def process_item(self, item):
 
         spider = self.spider
 
         data = {
-            "authority": item["authority"],
-            "category": item["category"],
-            "category_local": item["category_local"],
-            "event_data_key": item["source_file_url"],
-            "publication_date": item["publication_date"],
-            "publication_time": item["publication_time"],
-            "publication_datetime": item["publication_datetime"],
+            "authority": item.authority,
+            "category": item.category,
+            "category_local": item.category_local,
+            "event_data_key": item.source_file_url,
+            "publication_date": item.publication_date,
+            "publication_time": item.publication_time,
+            "publication_datetime": item.publication_datetime,
             "source_scraper": f"PortailEE Scraper",
-            "source_scraper_year": item["year"],
-            "source_file_url": item["source_file_url"],
-            "source_filename": item["source_filename"],
-            "source_page_url": item["source_page_url"],
-            "project_id": item["project_id"],
+            "source_scraper_year": item.year,
+            "source_file_url": item.source_file_url,
+            "source_filename": item.source_filename,
+            "source_page_url": item.source_page_url,
+            "project_id": item.project_id,
         }
 
-        adapter = ItemAdapter(item)
-        if adapter.get("departments") and adapter.get("departments_sources"):
-            data["departments"] = item["departments"]
-            data["departments_sources"] = item["departments_sources"]
+        if item.departments and item.departments_sources:
+            data["departments"] = item.departments
+            data["departments_sources"] = item.departments_sources
 
-        # if item["error"]:
+        # if item.error:
         #   data["_tag"] = "hidden"
 
         try:
             if not spider.dry_run:
-                spider.client.documents.upload(
-                    item["local_file_path"],
-                    project=spider.target_project,
-                    title=item["title"],
-                    description=item["project"],
-                    publish_at=item["publication_datetime_dcformat"],
-                    source="evaluation-environnementale.developpement-durable.gouv.fr",
-                    language="fra",
-                    access=spider.access_level,
-                    data=data,
+                # Upload in a thread so that the reactor keeps downloading.
+                # The DocumentCloud client is not thread-safe, hence the semaphore
+                await maybe_deferred_to_future(
+                    self.upload_semaphore.run(
+                        deferToThread,
+                        spider.client.documents.upload,
+                        item.local_file_path,
+                        project=spider.target_project,
+                        title=item.title,
+                        description=item.project,
+                        publish_at=item.publication_datetime_dcformat,
+                        source="evaluation-environnementale.developpement-durable.gouv.fr",
+                        language="fra",
+                        access=spider.access_level,
+                        data=data,
+                    )
                 )
         except Exception as e:
             raise Exception("Upload error").with_traceback(e.__traceback__)
 
         else:  # No upload error, add to event_data
             # last_modified = datetime.datetime.strptime(
-            #     item["publication_lastmodified"], "%a, %d %b %Y %H:%M:%S %Z"
+            #     item.publication_lastmodified, "%a, %d %b %Y %H:%M:%S %Z"
             # ).isoformat()
             now = datetime.datetime.now().isoformat(timespec="seconds")
 
-            spider.event_data[item["source_file_url"]] = {
+            spider.event_data[item.source_file_url] = {
                 # "last_modified": last_modified,
                 "last_seen": now,
-                "target_year": item["year"],
+                "target_year": item.year,
                 # "run_id": spider.run_id,
             }
+            spider.event_data_ids.add(event_data_file_id(item.source_file_url))
 
-            # Save event data after each upload
+            # Save event data periodically
             if spider.run_id:  # only from the web interface
-                spider.store_event_data(spider.event_data)
+                self._dirty_count += 1
+                if (
+                    self._dirty_count >= self.EVENT_DATA_FLUSH_SIZE
+                    or time.monotonic() - self._last_flush
+                    > self.EVENT_DATA_FLUSH_INTERVAL
+                ):
+                    self._dirty_count = 0
+                    self._last_flush = time.monotonic()
+                    # Through the semaphore, so that the client is never used by
+                    # two threads at once (on a copy, as uploads keep adding to it)
+                    await maybe_deferred_to_future(
+                        self.upload_semaphore.run(
+                            deferToThread,
+                            spider.store_event_data,
+                            dict(spider.event_data),
+                        )
+                    )
 
         return item
 
@@ -319,16 +408,16 @@ class UploadPipeline(SpiderPipeline):
                 timestamp = now.strftime("%Y%m%d_%H%M")
                 filename = f"event_data_PEE_{timestamp}.json"
 
-                with open(filename, "w+") as event_data_file:
-                    json.dump(spider.event_data, event_data_file)
+                with open(filename, "wb+") as event_data_file:
+                    event_data_file.write(dumps_json(spider.event_data))
                     spider.upload_file(event_data_file)
                 spider.logger.info(
                     f"Uploaded event data to the Documentcloud interface."
                 )
 
         if not spider.run_id:
-            with open("event_data.json", "w") as file:
-                json.dump(spider.event_data, file)
+            with open("event_data.json", "wb") as file:
+                file.write(dumps_json(spider.event_data))
                 spider.logger.info(
                     f"Saved file event_data.json ({len(spider.event_data)} documents)"
                 )
@@ -337,12 +426,35 @@ class UploadPipeline(SpiderPipeline):
 class MailPipeline(SpiderPipeline):
     """Send scraping run report."""
 
+    @staticmethod
+    def print_item(item, error=False):
+        item_string = f"""
+            title: {item.title}
+            project: {item.project}
+            authority: {item.authority}
+            category: {item.category}
+            category_local: {item.category_local}
+            publication_date: {item.publication_date}
+            source_file_url: {item.source_file_url}
+            source_page_url: {item.source_page_url}
+            """
+
+        if error:
+            item_string = item_string + f"\nfull_info: {item.full_info}"
+
+        return item_string
+
     def open_spider(self):
-        self.items = []
+        # Write the report to a temporary file instead of keeping the items
+        self.count = 0
+        self.report_file = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
 
     def process_item(self, item):
 
-        self.items.append(item)
+        if self.count:
+            self.report_file.write("\n\n")
+        self.report_file.write(self.print_item(item))
+        self.count += 1
 
         return item
 
@@ -350,36 +462,19 @@ class MailPipeline(SpiderPipeline):
 
         spider = self.spider
 
-        def print_item(item, error=False):
-            item_string = f"""
-            title: {item["title"]}
-            project: {item["project"]}
-            authority: {item["authority"]}
-            category: {item["category"]}
-            category_local: {item["category_local"]}
-            publication_date: {item["publication_date"]}
-            source_file_url: {item["source_file_url"]}
-            source_page_url: {item["source_page_url"]}
-            """
-
-            if error:
-                item_string = item_string + f"\nfull_info: {item['full_info']}"
-
-            return item_string
-
         if len(self.spider.target_years) == 1:
             year_range_str = str(self.spider.target_years[0])
         else:
             year_range_str = f"{str(self.spider.target_years[0])}-{str(self.spider.target_years[-1])}"
 
-        subject = f"PortailEE Scraper {year_range_str} (New: {len(self.items)}) [{spider.run_name}]"
+        subject = f"PortailEE Scraper {year_range_str} (New: {self.count}) [{spider.run_name}]"
 
         if spider.dry_run:
             subject = "[dry run] " + subject
 
-        content = f"SCRAPED ITEMS ({len(self.items)})\n\n" + "\n\n".join(
-            [print_item(item) for item in self.items]
-        )
+        self.report_file.seek(0)
+        content = f"SCRAPED ITEMS ({self.count})\n\n" + self.report_file.read()
+        self.report_file.close()
 
         start_content = f"PortailEE Scraper Addon Run {spider.run_id}"
 
@@ -393,8 +488,8 @@ class DeleteFilesPipeline:
 
     def process_item(self, item):
 
-        if os.path.isfile(item["local_file_path"]):
-            os.remove(item["local_file_path"])
+        if os.path.isfile(item.local_file_path):
+            os.remove(item.local_file_path)
 
         return item
 
@@ -24,16 +24,23 @@ USER_AGENT = "Disclose DocumentCloud Add-On - contact tech@disclose.ngo"
 ROBOTSTXT_OBEY = False
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-# CONCURRENT_REQUESTS = 32
+CONCURRENT_REQUESTS = 32
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
-DOWNLOAD_DELAY = 1.5
-# The download delay setting will honor only one of:
-# CONCURRENT_REQUESTS_PER_DOMAIN = 16
+# With a delay, a slot sends one request per delay whatever the concurrency,
+# so keep it low: AutoThrottle raises it if the gateway slows down
+DOWNLOAD_DELAY = 0.25
+
+# Maximum concurrent requests per website (default: 8), the others wait in
+# the slot's queue. All requests go to the PEE gateway, so this is its cap.
+CONCURRENT_REQUESTS_PER_DOMAIN = 16
 # CONCURRENT_REQUESTS_PER_IP = 16
 
+# Large attachments can take a while to come down from the PEE gateway
+DOWNLOAD_TIMEOUT = 360
+
 DOWNLOAD_WARNSIZE = 536870912  # 500 Mb
 DOWNLOAD_MAXSIZE = 1073741824 * 1  # Gb
 
@@ -88,12 +95,12 @@ ITEM_PIPELINES = {
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 AUTOTHROTTLE_ENABLED = True
 # The initial download delay
-AUTOTHROTTLE_START_DELAY = 5
+AUTOTHROTTLE_START_DELAY = 1
 # The maximum download delay to be set in case of high latencies
 # AUTOTHROTTLE_MAX_DELAY = 60
 # The average number of requests Scrapy should be sending in parallel to
 # each remote server
-AUTOTHROTTLE_TARGET_CONCURRENCY = 1.5
+AUTOTHROTTLE_TARGET_CONCURRENCY = 8
 # Enable showing throttling stats for every response received:
 # AUTOTHROTTLE_DEBUG = True
 
@@ -115,6 +122,15 @@ TELNETCONSOLE_ENABLED = False
 
 RETRY_TIMES = 4
 
+# Thread pool used for DNS resolution, file writes and DocumentCloud uploads
+# (default: 10)
+REACTOR_THREADPOOL_MAXSIZE = 20
+
+# Maximum number of DocumentCloud uploads running at once in that thread pool.
+# Keep at 1: the uploads share one DocumentCloud client, whose requests session
+# is not thread-safe and whose token refresh races between threads.
+UPLOAD_CONCURRENCY = 1
+
 # Development settings
 AUTOTHROTTLE_DEBUG = False
 HTTPCACHE_ENABLED = False
@@ -1,9 +1,12 @@
+import math
 import os
 import re
 from datetime import datetime, timedelta
 
 import scrapy
 from scrapy.exceptions import CloseSpider
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet.threads import deferToThread
 
 from ..items import DocumentItem
 
@@ -72,11 +75,37 @@ RESULTS_LIST_API_URL = "https://gatew-evaluation-environnementale.developpement-
 
 RESULTS_LENGTH = 100
 
+# In incremental mode, number of consecutive already scraped pages after which
+# the results of a target are not paginated further
+INCREMENTAL_STOP_PAGES = 3
+
 PROJECT_PAGE_API_URL = "https://gatew-evaluation-environnementale.developpement-durable.gouv.fr/api/PublishedDocument/GetByDocumentId?documentId={document_id}"
 
 PROJECT_PAGE_WEB_URL = "https://evaluation-environnementale.developpement-durable.gouv.fr/#/public/view-document/{document_id}"
 
-DOCUMENT_DOWNLOAD_URL = "https://gatew-evaluation-environnementale.developpement-durable.gouv.fr/api/Attachment/PublishedDownload?ctsFileId={file_id}"
+DOCUMENT_DOWNLOAD_URL_PREFIX = "https://gatew-evaluation-environnementale.developpement-durable.gouv.fr/api/Attachment/PublishedDownload?ctsFileId="
+
+
+def results_list_url(authority, region, page):
+    """Returns the URL of a page of results for an authority (and region)."""
+
+    url = RESULTS_LIST_API_URL.format(
+        start=(page - 1) * RESULTS_LENGTH,
+        length=RESULTS_LENGTH,
+        authority=authority,
+    )
+
+    if region:
+        url += f"&place={region}"
+
+    return url
+
+
+def write_file(path, body):
+    """Writes the bytes to the file at path."""
+
+    with open(path, "wb") as file:
+        file.write(body)
 
 
 class PEESpider(scrapy.Spider):
@@ -84,8 +113,16 @@ class PEESpider(scrapy.Spider):
 
     upload_limit_attained = False
 
+    incremental = False
+
     start_time = datetime.now()
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Create the folder to hold all files
+        os.makedirs("./downloaded_files", exist_ok=True)
+
     def check_time_limit(self):
         """Closes the spider automatically if it reaches a specified duration"""
 
@@ -112,29 +149,20 @@ class PEESpider(scrapy.Spider):
 
         for target in TARGETS:
 
-            url = RESULTS_LIST_API_URL.format(
-                start=0,
-                length=RESULTS_LENGTH,
-                authority=target["authority"],
-                # region=target["region"],
-            )
+            authority = target["authority"]
+            region = target["region"] if "region" in target else None
 
-            if "region" in target and target["region"]:
-                url += f"&place={target['region']}"
+            url = results_list_url(authority, region, 1)
 
             self.logger.debug(f"Will fetch results from URL : {url}")
 
             yield scrapy.Request(
                 url,
-                cb_kwargs=dict(
-                    authority=target["authority"],
-                    region=target["region"] if "region" in target else None,
-                    page=1,
-                ),
+                cb_kwargs=dict(authority=authority, region=region, page=1),
                 callback=self.parse_results,
             )
 
-    def parse_results(self, response, authority, region, page):
+    def parse_results(self, response, authority, region, page, scraped_pages=0):
 
         self.check_upload_limit()
         self.check_time_limit()
@@ -143,6 +171,10 @@ class PEESpider(scrapy.Spider):
         total = data["totalCount"]
         self.logger.info(f"Parsing {authority}/{region}, page {page}")
 
+        # Whether this page has projects already scraped / still to scrape
+        seen_scraped_project = False
+        seen_new_project = False
+
         # Yield a request per entry/project
         for project in data["data"]:
 
@@ -173,33 +205,55 @@ class PEESpider(scrapy.Spider):
                     else:
                         valid_file_ids.append(int(i))
 
-                already_fully_scraped = True
-                for f_id in valid_file_ids:
-                    if (
-                        not DOCUMENT_DOWNLOAD_URL.format(file_id=f_id)
-                        in self.event_data
-                    ):
-                        already_fully_scraped = False
+                # Stops at the first file that is not in event_data
+                already_fully_scraped = all(
+                    f_id in self.event_data_ids for f_id in valid_file_ids
+                )
 
                 if not already_fully_scraped:
+                    seen_new_project = True
                     yield scrapy.Request(
                         url,
                         callback=self.parse_project_page,
                         cb_kwargs=dict(document_id=doc_id),
                     )
-
-        # Next page
-        if page * RESULTS_LENGTH < total:
-
-            next_page_url = RESULTS_LIST_API_URL.format(
-                start=page * RESULTS_LENGTH,
-                length=RESULTS_LENGTH,
-                authority=authority,
-                region=region,
+                else:
+                    seen_scraped_project = True
+
+        # Count consecutive pages with only already scraped projects
+        if seen_new_project:
+            scraped_pages = 0
+        elif seen_scraped_project:
+            scraped_pages += 1
+
+        # Results are sorted by descending id, so in incremental mode the
+        # following pages should only hold projects that were already scraped.
+        # Runs cut short may have left holes, hence several pages are required.
+        if self.incremental and scraped_pages >= INCREMENTAL_STOP_PAGES:
+            self.logger.info(
+                f"Stopping {authority}/{region} at page {page}: already scraped"
             )
+            return
+
+        # Next pages
+        if self.incremental:
+            # One page at a time, to be able to stop early
+            next_pages = [page + 1] if page * RESULTS_LENGTH < total else []
+        elif page == 1:
+            # All the other pages at once, so they are fetched concurrently
+            next_pages = range(2, math.ceil(total / RESULTS_LENGTH) + 1)
+        else:
+            next_pages = []
+
+        for next_page in next_pages:
             yield scrapy.Request(
-                next_page_url,
-                cb_kwargs=dict(authority=authority, region=region, page=page + 1),
+                results_list_url(authority, region, next_page),
+                cb_kwargs=dict(
+                    authority=authority,
+                    region=region,
+                    page=next_page,
+                    scraped_pages=scraped_pages,
+                ),
                 callback=self.parse_results,
             )
 
@@ -237,8 +291,20 @@ class PEESpider(scrapy.Spider):
 
             file_id = a["id"]
 
+            try:
+                already_scraped = int(file_id) in self.event_data_ids
+            except (TypeError, ValueError):
+                self.logger.debug(
+                    f"Project {document_id}: Could not convert this attachment id to int: {file_id}"
+                )
+                already_scraped = (
+                    DOCUMENT_DOWNLOAD_URL_PREFIX + str(file_id) in self.event_data
+                )
+
             # Check event_data
-            if not DOCUMENT_DOWNLOAD_URL.format(file_id=file_id) in self.event_data:
+            if not already_scraped:
+
+                file_url = DOCUMENT_DOWNLOAD_URL_PREFIX + str(file_id)
 
                 # Publication Date
                 if a["folderName"] in ["Décision", "Avis"]:
@@ -264,7 +330,7 @@ class PEESpider(scrapy.Spider):
                     project=project_title,
                     authority=data["authority"],
                     category_local=data["categoryName"],
-                    source_file_url=DOCUMENT_DOWNLOAD_URL.format(file_id=file_id),
+                    source_file_url=file_url,
                     source_page_url=PROJECT_PAGE_WEB_URL.format(
                         document_id=document_id
                     ),
@@ -274,30 +340,26 @@ class PEESpider(scrapy.Spider):
                 )
 
                 yield scrapy.Request(
-                    doc_item["source_file_url"],
+                    doc_item.source_file_url,
                     callback=self.download_document,
                     cb_kwargs=dict(doc_item=doc_item, file_id=file_id),
                 )
 
-    def download_document(self, response, doc_item, file_id):
+    async def download_document(self, response, doc_item, file_id):
 
         self.check_upload_limit()
         self.check_time_limit()
 
-        # Create the folder to hold all files if it does not exist yet
-        if not os.path.exists("./downloaded_files"):
-            os.makedirs("./downloaded_files")
-
         # Create a folder to hold the current file if it does not exist yet
-        if not os.path.exists(f"./downloaded_files/{file_id}"):
-            os.makedirs(f"./downloaded_files/{file_id}")
+        os.makedirs(f"./downloaded_files/{file_id}", exist_ok=True)
 
-        # Save the file in the folder
+        # Save the file in the folder, in a thread so the reactor is not blocked
 
-        local_file_path = f"./downloaded_files/{file_id}/{doc_item['source_filename']}"
-        with open(local_file_path, "wb") as file:
-            file.write(response.body)
+        local_file_path = f"./downloaded_files/{file_id}/{doc_item.source_filename}"
+        await maybe_deferred_to_future(
+            deferToThread(write_file, local_file_path, response.body)
+        )
 
-        doc_item["local_file_path"] = local_file_path
+        doc_item.local_file_path = local_file_path
 
         yield doc_item